@@ -8,14 +8,21 @@
 ############################################
 
 import os
+import glob
 import subprocess
 import zipfile
+import struct
+import zlib
+import time
+import collections
+import contextlib
 import re
 import getopt
 import sys
 import shutil
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from mk_exception import *
-from fnmatch import fnmatch
 
 def getenv(name, default):
     try:
@@ -41,8 +48,12 @@ X86ONLY = False
 X64ONLY = False
 ARM64ONLY = False  # ARM64 flag
 MAKEJOBS = getenv("MAKEJOBS", "24")
+CMAKE_GENERATOR = 'Ninja'
+VS_DEFAULT_VCDIR = 'C:\\Program Files\\Microsoft Visual Studio\\2022\\Enterprise\\VC\\'
+# vcvarsall.bat argument for each architecture
+VCVARS_ARCHS = {'x64': 'x64', 'x86': 'x86', 'arm64': 'x64_arm64'}
 
-ARCHS = []
+ARCHS = {}
 
 def set_verbose(flag):
     global VERBOSE
@@ -55,16 +66,36 @@ def mk_dir(d):
     if not os.path.exists(d):
         os.makedirs(d)
 
+# Run fn for every architecture concurrently.
+# The per-architecture steps are independent and spend their time
+# in subprocesses, so threads are enough to overlap them.
+def for_each_arch(fn):
+    global ARCHS
+    with ThreadPoolExecutor(max_workers=len(ARCHS)) as ex:
+        list(ex.map(fn, ARCHS))
+
+# Share total parallel jobs among the architectures built concurrently
+def jobs_per_arch(total):
+    global ARCHS
+    return max(1, int(total) // max(1, len(ARCHS)))
+
 def set_build_dir(path):
     global BUILD_DIR, BUILD_X86_DIR, BUILD_X64_DIR, BUILD_ARM64_DIR, ARCHS
     BUILD_DIR = os.path.expanduser(os.path.normpath(path))
     BUILD_X86_DIR = os.path.join(path, 'x86')
     BUILD_X64_DIR = os.path.join(path, 'x64')
     BUILD_ARM64_DIR = os.path.join(path, 'arm64')  # Set ARM64 build directory
-    ARCHS = {'x64': BUILD_X64_DIR, 'x86':BUILD_X86_DIR, 'arm64':BUILD_ARM64_DIR}
-    mk_dir(BUILD_X86_DIR)    
-    mk_dir(BUILD_X64_DIR)
-    mk_dir(BUILD_ARM64_DIR)
+    # Only the selected architectures, all of them if none was selected
+    all_archs = not (X86ONLY or X64ONLY or ARM64ONLY)
+    ARCHS = {}
+    if X64ONLY or all_archs:
+        ARCHS['x64'] = BUILD_X64_DIR
+    if X86ONLY or all_archs:
+        ARCHS['x86'] = BUILD_X86_DIR
+    if ARM64ONLY or all_archs:
+        ARCHS['arm64'] = BUILD_ARM64_DIR
+    for d in ARCHS.values():
+        mk_dir(d)
 
 def display_help():
     print("mk_win_dist.py: Z3 Windows distribution generator\n")
@@ -142,32 +173,55 @@ def parse_options():
             raise MKException("Invalid command line option '%s'" % opt)
     set_build_dir(path)
 
-# Check whether build directory already exists or not
+# Check whether build directory already exists and is configured
+# for the current top-level CMakeLists.txt (the build directory is
+# configured with ../.. as source directory)
 def check_build_dir(path):
-    return os.path.exists(path) and os.path.exists(os.path.join(path, 'Makefile'))
+    cache = os.path.join(path, 'CMakeCache.txt')
+    root_cml = os.path.join(path, '..', '..', 'CMakeLists.txt')
+    return (os.path.exists(os.path.join(path, 'build.ninja')) and os.path.exists(cache) and
+            os.path.getmtime(cache) >= os.path.getmtime(root_cml))
+
+# Return the CMake generator the build directory was configured with,
+# None if it has not been configured yet
+def get_cache_generator(path):
+    cache = os.path.join(path, 'CMakeCache.txt')
+    if not os.path.exists(cache):
+        return None
+    with open(cache, errors='replace') as f:
+        for line in f:
+            if line.startswith('CMAKE_GENERATOR:'):
+                return line.split('=', 1)[1].strip()
+    return None
 
 def check_output(cmd):
-    out = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
-    if out != None:
-        enc = sys.getdefaultencoding()
-        if enc != None: return out.decode(enc).rstrip('\r\n')
-        else: return out.rstrip('\r\n')
-    else:
-        return ""
+    return subprocess.run(cmd, stdout=subprocess.PIPE, check=True, encoding='utf-8',
+                          errors='replace').stdout.rstrip('\r\n')
 
+@functools.lru_cache(maxsize=1)
 def get_git_hash():
     try:
-        branch = check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'])
-        r = check_output(['git', 'show-ref', '--abbrev=12', 'refs/heads/%s' % branch])
+        r = check_output(['git', 'rev-parse', '--short=12', 'HEAD'])
     except:
         raise MKException("Failed to retrieve git hash")
-    ls = r.split(' ')
-    if len(ls) != 2:
+    if not r or ' ' in r:
         raise MKException("Unexpected git output " + r)
-    return ls[0]
+    return r
 
 
 
+# Return the version of cmake as a tuple of integers
+@functools.lru_cache(maxsize=1)
+def get_cmake_version():
+    try:
+        out = check_output(['cmake', '--version'])
+    except:
+        raise MKException("Failed to run cmake")
+    m = re.search(r'cmake version (\d+)\.(\d+)', out)
+    if not m:
+        raise MKException("Unexpected cmake output " + out)
+    return (int(m.group(1)), int(m.group(2)))
+
 # Create a build directory using mk_make.py
 def mk_build_dir(arch):
     global ARCHS
@@ -175,13 +229,16 @@ def mk_build_dir(arch):
     install_path = DIST_DIR
     if not check_build_dir(build_path) or FORCE_MK:
         mk_dir(build_path)
-
-        if arch == "arm64":
-            arch = "amd64_arm64"
+        generator = get_cache_generator(build_path)
+        if generator is not None and generator != CMAKE_GENERATOR:
+            # CMake refuses to switch the generator of a configured
+            # build directory, e.g. one set up for NMake by older versions
+            # of this script, so start over
+            print("Removing CMake cache for '%s' in %s" % (generator, build_path))
+            os.remove(os.path.join(build_path, 'CMakeCache.txt'))
+            shutil.rmtree(os.path.join(build_path, 'CMakeFiles'), ignore_errors=True)
 
         cmds = []
-        cmds.append(f"cd {build_path}")
-        cmds.append(f"call \"C:\\Program Files\\Microsoft Visual Studio\\2022\\Enterprise\\VC\\Auxiliary\\Build\\vcvarsall.bat\" {arch}")
         cmd = []
         cmd.append("cmake -S .")
         if DOTNET_CORE_ENABLED:
@@ -204,21 +261,27 @@ def mk_build_dir(arch):
         cmd.append(' -DZ3_BUILD_LIBZ3_SHARED=ON')
         cmd.append(' -DCMAKE_BUILD_TYPE=RelWithDebInfo')
         cmd.append(' -DCMAKE_INSTALL_PREFIX=' + install_path)
-        cmd.append(' -G "NMake Makefiles"')
-        cmd.append(' ../..\n')
+        cmd.append(' -G "%s"' % CMAKE_GENERATOR)
+        if shutil.which('sccache'):
+            cmd.append(' -DCMAKE_C_COMPILER_LAUNCHER=sccache')
+            cmd.append(' -DCMAKE_CXX_COMPILER_LAUNCHER=sccache')
+            # sccache cannot cache objects compiled with /Zi,
+            # embed the debug information in the objects (/Z7) instead
+            if get_cmake_version() >= (3, 25):
+                cmd.append(' -DCMAKE_POLICY_DEFAULT_CMP0141=NEW')
+                cmd.append(' -DCMAKE_MSVC_DEBUG_INFORMATION_FORMAT=Embedded')
+            else:
+                # Older CMake versions hard code /Zi in the default flags
+                cmd.append(' "-DCMAKE_C_FLAGS_RELWITHDEBINFO=/Z7 /O2 /Ob1 /DNDEBUG"')
+                cmd.append(' "-DCMAKE_CXX_FLAGS_RELWITHDEBINFO=/Z7 /O2 /Ob1 /DNDEBUG"')
+        cmd.append(' ../..')
         cmds.append("".join(cmd))
         print(cmds)
         sys.stdout.flush()
-        if exec_cmds(cmds) != 0:
+        if exec_cmds(cmds, cwd=build_path, env=get_vcvars_env(arch)) != 0:
             raise MKException("failed to run commands")
 
 
-# Create build directories
-def mk_build_dirs():
-    global ARCHS
-    for k in ARCHS:
-        mk_build_dir(k)
-    
 # Check if on Visual Studio command prompt
 def check_vc_cmd_prompt():
     try:
@@ -227,23 +290,34 @@ def check_vc_cmd_prompt():
     except:
         raise MKException("You must execute the mk_win_dist.py script on a Visual Studio Command Prompt")
 
-def exec_cmds(cmds):
-    cmd_file = 'z3_tmp.cmd'
-    f = open(cmd_file, 'w')
-    for cmd in cmds:
-        f.write(cmd)
-        f.write('\n')
-    f.close()
-    res = 0
+# Return the environment set up by vcvarsall.bat for arch.
+# Running vcvarsall.bat is slow, so this is done once per architecture
+# and the result is passed to the build commands.
+@functools.lru_cache(maxsize=None)
+def get_vcvars_env(arch):
+    vcdir = getenv('VCINSTALLDIR', VS_DEFAULT_VCDIR)
+    vcvarsall = os.path.join(vcdir, 'Auxiliary', 'Build', 'vcvarsall.bat')
+    marker = '__Z3_VCVARS_ENV__'
     try:
-        res = subprocess.call(cmd_file, shell=True)
+        out = subprocess.run('call "%s" %s && echo %s && set' % (vcvarsall, VCVARS_ARCHS[arch], marker),
+                             shell=True, stdout=subprocess.PIPE, check=True, encoding='oem',
+                             errors='replace').stdout
     except:
-        res = 1
+        raise MKException("Failed to run '%s' for %s" % (vcvarsall, arch))
+    env = {}
+    # Skip whatever vcvarsall.bat printed before the environment
+    for line in out.split(marker, 1)[-1].splitlines():
+        name, sep, value = line.partition('=')
+        if sep and name:
+            env[name] = value
+    return env
+
+def exec_cmds(cmds, cwd=None, env=None):
+    # Run the commands in a single shell, stopping at the first failure
     try:
-        os.erase(cmd_file)
+        return subprocess.call(' && '.join(cmds), shell=True, cwd=cwd, env=env)
     except:
-        pass
-    return res
+        return 1
 
 def get_build_dir(arch):
     global ARCHS
@@ -251,20 +325,16 @@ def get_build_dir(arch):
 
 def mk_z3(arch):
     build_dir = get_build_dir(arch)
-    if arch == "arm64":
-        arch = "x64_arm64"
+    jobs = jobs_per_arch(MAKEJOBS)
+    env = dict(get_vcvars_env(arch))
+    env['CMAKE_BUILD_PARALLEL_LEVEL'] = str(jobs)
     cmds = []
-    cmds.append('call "%VCINSTALLDIR%Auxiliary\\build\\vcvarsall.bat" ' + arch)
-    cmds.append('cd %s' % build_dir)
-    cmds.append('nmake install')
-    if exec_cmds(cmds) != 0:
+    cmds.append('cmake --build . --parallel %s --target install --config RelWithDebInfo' % jobs)
+    if exec_cmds(cmds, cwd=build_dir, env=env) != 0:
         raise MKException("Failed to make z3")
 
-def mk_z3s():
-    global ARCHS
-    for k in ARCHS:
-        mk_z3(k)
-
+# Only depends on arch once the options have been parsed
+@functools.lru_cache(maxsize=None)
 def get_z3_name(arch):
     global ASSEMBLY_VERSION
     version = "4"
@@ -277,44 +347,206 @@ def get_z3_name(arch):
         return 'z3-%s-%s-win' % (version, arch)
 
      
+# Members that are already compressed archives are stored as is,
+# deflating them again costs time and gains nothing.
+ZIP_STORED_EXTS = ('.jar', '.nupkg', '.zip')
+# Deflate level for the remaining members, level 1 is much faster than
+# the default and produces archives that are only slightly larger.
+ZIP_COMPRESSLEVEL = 1
+# Buffer size for reading members and writing the archive
+ZIP_BUFFER_SIZE = 64 * 1024
+
+# Names of distribution archives at the top of dist_dir
+DIST_ZIP_RE = re.compile(r'z3-[^/]*-win\.zip$')
+
+def zip_compress_type(fname):
+    if fname.lower().endswith(ZIP_STORED_EXTS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+# Return the size, CRC and compressed data of the file fname.
+# Runs in a worker process.
+def compress_zip_member(fname, method, level):
+    size = 0
+    crc = 0
+    chunks = []
+    c = zlib.compressobj(level, zlib.DEFLATED, -15) if method == zipfile.ZIP_DEFLATED else None
+    with open(fname, 'rb') as f:
+        while True:
+            buf = f.read(ZIP_BUFFER_SIZE)
+            if not buf:
+                break
+            size += len(buf)
+            crc = zlib.crc32(buf, crc)
+            chunks.append(c.compress(buf) if c else buf)
+    if c:
+        chunks.append(c.flush())
+    return size, crc, b''.join(chunks)
+
+# Return the raw (still compressed) data of the entry zinfo in zf
+def read_raw_zip_entry(zf, zinfo):
+    zf.fp.seek(zinfo.header_offset)
+    header = zf.fp.read(30)
+    if len(header) != 30 or header[:4] != b'PK\003\004':
+        raise MKException("Bad zip entry header for '%s'" % zinfo.filename)
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    zf.fp.seek(name_len + extra_len, 1)
+    return zf.fp.read(zinfo.compress_size)
+
+# Append an entry whose data is already compressed according to zinfo.
+# zipfile has no public API for this, so the local header is written
+# directly and the entry is registered for the central directory.
+# This relies on CPython zipfile internals (fp, start_dir, filelist,
+# NameToInfo), checked with Python 3.11, and bypasses the duplicate
+# name check and the ZipFile lock: only use it from a single thread
+# on an archive being written from scratch.
+def write_raw_zip_entry(zf, zinfo, data):
+    zinfo.flag_bits &= ~0x08
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader())
+    zf.fp.write(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+
+# Return True if the archive member zinfo matches the file with stat st.
+# Zip timestamps are in local time with a resolution of 2 seconds.
+def zip_member_unchanged(zinfo, st):
+    zip_time = time.mktime(zinfo.date_time + (0, 0, -1))
+    return zinfo.file_size == st.st_size and abs(st.st_mtime - zip_time) < 2
+
+# Yield (entry, relative name) for the files below path, using '/' as
+# separator in the relative names. os.scandir returns the file attributes
+# along with the directory entries on Windows, and entry.path is built
+# while reading the directory, so no per-file stat or path join is needed.
+def scan_files(path):
+    todo = [(path, '')]
+    while todo:
+        d, prefix = todo.pop()
+        with os.scandir(d) as it:
+            for entry in it:
+                if entry.is_dir():
+                    todo.append((entry.path, prefix + entry.name + '/'))
+                elif entry.is_file():
+                    yield entry, prefix + entry.name
+
 def mk_zip(arch):
     global ARCHS
     build_dir = ARCHS[arch]
     dist_dir = os.path.join(build_dir, DIST_DIR)
     dist_name = get_z3_name(arch)
-    old = os.getcwd()
-    try:
-        os.chdir(dist_dir)
-        zfname = '%s.zip' % dist_name
-        zipout = zipfile.ZipFile(zfname, 'w', zipfile.ZIP_DEFLATED)
-        for root, dirs, files in os.walk(dist_path):
-            for f in files:
-                zipout.write(os.path.join(root, f))
+    # Do not chdir into dist_dir, the working directory is shared by
+    # all threads when architectures are built concurrently.
+    zfname = '%s.zip' % dist_name
+    zfpath = os.path.join(dist_dir, zfname)
+    # Collect (path, archive name, stat) of the files to include.
+    # The archive is written to dist_dir, skip it and any archive left
+    # there by earlier runs, e.g. with a different version or git hash.
+    files = [(entry.path, relname, entry.stat())
+             for entry, relname in scan_files(dist_dir) if not DIST_ZIP_RE.match(relname)]
+    prev_valid = False
+    if os.path.exists(zfpath):
+        # The archive is up to date if it has the same members, each with
+        # the size and modification time of the corresponding file
+        try:
+            # 7-Zip also stores entries for directories, ignore them
+            with zipfile.ZipFile(zfpath, 'r') as z:
+                zip_infos = {n: i for n, i in z.NameToInfo.items() if not i.is_dir()}
+            prev_valid = True
+        except zipfile.BadZipFile:
+            zip_infos = None
+        if (zip_infos is not None and
+            set(zip_infos) == {arcname for _, arcname, _ in files} and
+            all(zip_member_unchanged(zip_infos[arcname], st) for _, arcname, st in files)):
+            if is_verbose():
+                print("'%s' is up to date" % zfname)
+            return
+    # 7-Zip deflates using all cores, use it when it is available and
+    # there is no previous archive. It always packs everything and
+    # deflates every member, including ZIP_STORED_EXTS, so when a previous
+    # archive exists the Python path below, which reuses unchanged
+    # entries, is usually faster.
+    if shutil.which('7z') and not prev_valid:
+        if os.path.exists(zfpath):
+            os.remove(zfpath)
+        if subprocess.call(['7z', 'a', '-tzip', '-mmt=on', '-mx=1', '-xr-!z3-*-win.zip', zfname, '*'],
+                           cwd=dist_dir) != 0:
+            raise MKException("Failed to create '%s' with 7z" % zfname)
         if is_verbose():
             print("Generated '%s'" % zfname)
+        return
+    prev_zfpath = None
+    if os.path.exists(zfpath) and not prev_valid:
+        os.remove(zfpath)
+    elif os.path.exists(zfpath):
+        # Keep the previous archive around so that entries for
+        # files that did not change can be copied without deflating
+        # them again.
+        prev_zfpath = os.path.join(build_dir, zfname + '.prev')
+        os.replace(zfpath, prev_zfpath)
+    try:
+        with (zipfile.ZipFile(prev_zfpath, 'r') if prev_zfpath else contextlib.nullcontext()) as prev, \
+             open(zfpath, 'wb', buffering=ZIP_BUFFER_SIZE) as zf, \
+             zipfile.ZipFile(zf, 'w', zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zipout:
+            # Members are compressed by a pool of processes and written
+            # to the archive here, in order, as they become available.
+            # Only a few jobs are kept ahead of the writer, so that the
+            # compressed data does not pile up in memory.
+            workers = jobs_per_arch(os.cpu_count() or 1)
+            pending = collections.deque()
+            def write_next():
+                zinfo, job = pending.popleft()
+                if job is None:
+                    write_raw_zip_entry(zipout, zinfo, read_raw_zip_entry(prev, zinfo))
+                else:
+                    zinfo.file_size, zinfo.CRC, data = job.result()
+                    zinfo.compress_size = len(data)
+                    write_raw_zip_entry(zipout, zinfo, data)
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                for fname, arcname, st in files:
+                    method = zip_compress_type(fname)
+                    zinfo = prev.NameToInfo.get(arcname) if prev else None
+                    if zinfo and zip_member_unchanged(zinfo, st) and zinfo.compress_type == method:
+                        pending.append((zinfo, None))
+                    else:
+                        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+                        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+                        zinfo.compress_type = method
+                        pending.append((zinfo, ex.submit(compress_zip_member, fname, method, ZIP_COMPRESSLEVEL)))
+                    if len(pending) > 2 * workers:
+                        write_next()
+                while pending:
+                    write_next()
     except:
-        pass
-    os.chdir(old)
-
-# Create a zip file for each platform
-def mk_zips():
-    global ARCHS
-    for k in ARCHS:
-        mk_zip(k)
-
-
-VS_RUNTIME_PATS = [re.compile(r'vcomp.*\.dll'),
-                   re.compile(r'msvcp.*\.dll'),
-                   re.compile(r'msvcr.*\.dll'),
-                   re.compile(r'vcrun.*\.dll')]
-
-# Copy Visual Studio Runtime libraries
-def cp_vs_runtime(arch):
-    platform = arch
+        # Do not leave a partial archive behind
+        if os.path.exists(zfpath):
+            os.remove(zfpath)
+        raise
+    finally:
+        if prev_zfpath:
+            os.remove(prev_zfpath)
+    if is_verbose():
+        print("Generated '%s'" % zfname)
+
+
+# Names of the runtime DLLs to include, matched against file names only
+VS_RUNTIME_DLL_RE = re.compile(r'(?:vcomp|msvcp|msvcr|vcrun)[^\\/]*\.dll$', re.I)
+
+# Sort key for redist version directories, numeric versions such as
+# 14.38.33135 order after anything else
+def vs_version_key(version):
+    if re.fullmatch(r'\d+(\.\d+)*', version):
+        return (1, tuple(int(n) for n in version.split('.')))
+    return (0, ())
+
+# Find the Visual Studio Runtime libraries for all architectures.
+# Returns a dictionary from architecture to list of files.
+@functools.lru_cache(maxsize=1)
+def scan_vs_redist():
     vcdir = os.environ['VCINSTALLDIR']
     path  = '%sredist' % vcdir
-    vs_runtime_files = []
-    print("Walking %s" % path)
+    vs_runtime_files = {}
+    print("Searching %s" % path)
     # Everything changes with every release of VS
     # Prior versions of VS had DLLs under "redist\x64"
     # There are now several variants of redistributables
@@ -322,38 +554,55 @@ def cp_vs_runtime(arch):
     # we use a "check_root" filter to find some hopefully suitable
     # redistributable.
     def check_root(root):
-        return platform in root and ("CRT" in root or "MP" in root) and "onecore" not in root and "debug" not in root
-    for root, dirs, files in os.walk(path):
-        for filename in files:
-            if fnmatch(filename, '*.dll') and check_root(root):
-                print("Checking %s %s" % (root, filename))
-                for pat in VS_RUNTIME_PATS:
-                    if pat.match(filename):
-                        fname = os.path.join(root, filename)
-                        if not os.path.isdir(fname):
-                            vs_runtime_files.append(fname)
+        return ("CRT" in root or "MP" in root) and "onecore" not in root and "debug" not in root
+    # Since VS 2017 the redistributables live in
+    # redist\MSVC\<version>\<arch>\Microsoft.VC<toolset>.<component>,
+    # only look there instead of walking the whole redist tree.
+    pattern = os.path.join(path, 'MSVC', '*', '*', 'Microsoft.VC*', '*.dll')
+    for fname in glob.iglob(pattern):
+        root, filename = os.path.split(fname)
+        if VS_RUNTIME_DLL_RE.match(filename) and check_root(root):
+            print("Checking %s %s" % (root, filename))
+            if not os.path.isdir(fname):
+                platform_dir = os.path.dirname(root)
+                platform = os.path.basename(platform_dir)
+                version = os.path.basename(os.path.dirname(platform_dir))
+                vs_runtime_files.setdefault(platform, {}).setdefault(version, []).append(fname)
+    # Several redist versions may be installed side by side, only use the
+    # newest one so that each DLL is copied from a single place
+    return {platform: versions[max(versions, key=vs_version_key)]
+            for platform, versions in vs_runtime_files.items()}
+
+# Copy Visual Studio Runtime libraries
+def cp_vs_runtime(arch):
+    vs_runtime_files = scan_vs_redist().get(arch, [])
     if not vs_runtime_files:
         raise MKException("Did not find any runtime files to include")
     build_dir = get_build_dir(arch)
     bin_dist_path = os.path.join(build_dir, DIST_DIR, 'bin')
+    # Copy with one robocopy call per source directory
+    by_dir = {}
     for f in vs_runtime_files:
-        shutil.copy(f, bin_dist_path)
+        src_dir, filename = os.path.split(f)
+        by_dir.setdefault(src_dir, []).append(filename)
+    # Fail quickly instead of retrying for days when the destination
+    # is locked.
+    def copy_dir(src_dir):
+        return subprocess.call(['robocopy', src_dir, bin_dist_path] + by_dir[src_dir] +
+                               ['/R:1', '/W:1', '/MT:8', '/NJH', '/NJS', '/NP', '/NDL'])
+    with ThreadPoolExecutor(max_workers=min(8, len(by_dir))) as ex:
+        results = list(ex.map(copy_dir, by_dir))
+    for src_dir, res in zip(by_dir, results):
+        # robocopy exit codes below 8 indicate success
+        if res >= 8:
+            raise MKException("Failed to copy runtime files from '%s'" % src_dir)
         if is_verbose():
-            print("Copied '%s' to '%s'" % (f, bin_dist_path))
+            for filename in by_dir[src_dir]:
+                print("Copied '%s' to '%s'" % (os.path.join(src_dir, filename), bin_dist_path))
 
-def cp_vs_runtimes():
-    global ARCHS
-    for k in ARCHS:        
-        cp_vs_runtime(k)
-        
 def cp_license(arch):
     shutil.copy("LICENSE.txt", os.path.join(DIST_DIR, get_z3_name(arch)))
 
-def cp_licenses():
-    global ARCHS
-    for k in ARCHS:                
-        cp_license(k)
-
 
 def build_for_arch(arch):
     global ARCHS
@@ -372,19 +621,17 @@ def main():
     parse_options()
     check_vc_cmd_prompt()
 
-    if X86ONLY:
-        build_for_arch("x86")
-    elif X64ONLY:
-        build_for_arch("x64")
-    elif ARM64ONLY: 
-        build_for_arch("arm64")
-    else:
-        mk_build_dirs()
-        mk_z3s()
-        cp_licenses()
-        cp_vs_runtimes()
-        if ZIP_BUILD_OUTPUTS:
-            mk_zips()
-
-main()
+    # lru_cache does not stop concurrent first calls from all doing the
+    # work, so fill the caches before the architecture threads start
+    if GIT_HASH:
+        get_git_hash()
+    scan_vs_redist()
+    if shutil.which('sccache'):
+        get_cmake_version()
+
+    for_each_arch(build_for_arch)
+
+# The zip workers re-import this script, do not build from them
+if __name__ == '__main__':
+    main()
 